@@ -0,0 +1,42 @@
+import pytest
+
+from twitpred.predictor import TweetVectorizer
+
+
+@pytest.fixture
+def vectorizer() -> TweetVectorizer:
+    return TweetVectorizer(token_mapping={})
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("check https://example.com/foo out", "check <url> out"),
+        ("hey @some_user what's up", "hey <user> what's up"),
+        ("loving the #new_year vibes", "loving the <hashtag> vibes"),
+        ("scored 4.5 out of 10", "scored <number> out of <number>"),
+        ("great news :-)", "great news <smileface>"),
+        ("so sad :(", "so sad <sadface>"),
+    ],
+)
+def test_preprocess_placeholders(
+    vectorizer: TweetVectorizer, text: str, expected: str
+) -> None:
+    assert vectorizer.preprocess(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        # the username alternative matches before the url pattern sees the
+        # domain; the sequential passes used to produce "me<user><url>"
+        ("mail me@example.com", "mail me<user>.com"),
+        # "<3" is an emoticon without a placeholder mapping, so it is kept
+        # intact; the sequential passes used to produce "<<number>"
+        ("love you <3", "love you <3"),
+    ],
+)
+def test_preprocess_divergences(
+    vectorizer: TweetVectorizer, text: str, expected: str
+) -> None:
+    assert vectorizer.preprocess(text) == expected
@@ -0,0 +1,76 @@
+"""Convert a Keras HDF5 model to an int8-quantized TF-Lite model.
+
+The quantized model halves the weight memory traffic and roughly doubles
+the ALU throughput of the CPU-only predictor workers. Pass the resulting
+file to twitpred via --model; it is picked up by its .tflite extension.
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from typing import TYPE_CHECKING, Iterator, List
+
+import numpy as np
+import tensorflow as tf
+
+if TYPE_CHECKING:
+    import numpy.typing as npt
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=100,
+        help="Number of representative samples used to calibrate the quantization",
+    )
+    parser.add_argument(
+        "--max-len",
+        type=int,
+        default=64,
+        metavar="L",
+        help="Token length of the representative samples",
+    )
+
+    # required arguments
+    required_args = parser.add_argument_group("required arguments")
+    required_args.add_argument(
+        "-m", "--model", required=True, help="TensorFlow HDF5 file"
+    )
+    required_args.add_argument(
+        "-o", "--output", required=True, help="Output TF-Lite file"
+    )
+
+    return parser
+
+
+def quantize(model_file: str, output_file: str, samples: int, max_len: int) -> None:
+    model = tf.keras.models.load_model(model_file)
+    embedding = next(
+        layer
+        for layer in model.layers
+        if isinstance(layer, tf.keras.layers.Embedding)
+    )
+    vocabulary_size = embedding.input_dim
+
+    def representative_dataset() -> "Iterator[List[npt.NDArray[np.int32]]]":
+        rng = np.random.default_rng(0)
+        for _ in range(samples):
+            yield [rng.integers(0, vocabulary_size, (1, max_len)).astype(np.int32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(output_file, "wb") as f:
+        f.write(converter.convert())
+
+
+def main() -> None:
+    args = get_parser().parse_args()
+    quantize(args.model, args.output, args.samples, args.max_len)
+
+
+if __name__ == "__main__":
+    main()
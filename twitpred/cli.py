@@ -41,6 +41,25 @@ def get_parser() -> ArgumentParser:
         default=1,
         help="Number of predictor processes to run in parallel",
     )
+    parser.add_argument(
+        "--vectorizer-processes",
+        type=int,
+        default=1,
+        help="Number of vectorizer processes to run in parallel (if --processes > 1)",
+    )
+    parser.add_argument(
+        "--cores-per-worker",
+        type=int,
+        help="Pin each predictor process to this many dedicated CPU cores "
+        "(if --processes > 1)",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=int,
+        default=100,
+        help="Maximum time in milliseconds a vectorizer process may hold a "
+        "partial batch before passing it on for scoring (if --processes > 1)",
+    )
     parser.add_argument(
         "--loglevel",
         default="INFO",
@@ -54,7 +73,7 @@ def get_parser() -> ArgumentParser:
         "-c", "--credentials", required=True, help="Twitter API credentials YAML file"
     )
     required_args.add_argument(
-        "-m", "--model", required=True, help="TensorFlow HDF5 file"
+        "-m", "--model", required=True, help="TensorFlow HDF5 or quantized .tflite file"
     )
     required_args.add_argument(
         "-v", "--vocabulary", required=True, help="Word-to-index vocabulary JSON file"
@@ -106,7 +125,13 @@ def main() -> None:
         batch_size=args.batch,
     )
     if args.processes > 1:
-        multiprocess_tweets(num_processes=args.processes, **params)
+        multiprocess_tweets(
+            num_processes=args.processes,
+            num_vectorizer_processes=args.vectorizer_processes,
+            max_wait=args.max_wait_ms / 1000,
+            cores_per_worker=args.cores_per_worker,
+            **params,
+        )
     else:
         process_tweets(**params)
 
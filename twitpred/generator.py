@@ -1,8 +1,10 @@
 import itertools as it
 import logging
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from queue import Queue
-from typing import Any, Callable, Iterator, Optional, Sequence
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
 
 import tweepy
 import yaml
@@ -29,6 +31,29 @@ class Tweet(namedtuple("_Tweet", ["id", "created_at", "full_text"])):
         raise AssertionError(f"Cannot determine text from status {status!r}")
 
 
+class TweetBatch:
+    """Struct-of-arrays storage for a batch of tweets.
+
+    The hot paths traverse whole batches field by field (all the texts, then
+    all the ids, ...), so storing one list per field avoids a Python
+    attribute access per tweet per traversal.
+    """
+
+    __slots__ = ("ids", "times", "texts")
+
+    def __init__(self, tweets: Iterable[Tweet]):
+        self.ids: List[int] = []
+        self.times: List[datetime] = []
+        self.texts: List[str] = []
+        for tweet in tweets:
+            self.ids.append(tweet.id)
+            self.times.append(tweet.created_at)
+            self.texts.append(tweet.full_text)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
 def get_twitter_api(credentials_yaml: str) -> tweepy.API:
     with open(credentials_yaml) as f:
         credentials = yaml.safe_load(f)["twitter_credentials"]
@@ -48,13 +73,13 @@ def generate_tweets(
     streaming: bool = False,
 ) -> Iterator[Tweet]:
     if streaming:
-        iter_statuses = StatusStreamGenerator(
+        iter_statuses: Iterable[tweepy.Status] = StatusStreamGenerator(
             api=api, limit=limit, track=terms, languages=[lang] if lang else None
         )
     else:
-        iter_statuses = tweepy.Cursor(
-            api.search, q=" OR ".join(terms), lang=lang, tweet_mode="extended"
-        ).items(limit)
+        iter_statuses = it.islice(
+            iter_search_statuses(api, terms, lang), limit or None
+        )
 
     for status in iter_statuses:
         # Keep the retweeted status if this status is a retweet
@@ -62,6 +87,26 @@ def generate_tweets(
         yield Tweet.from_status(status)
 
 
+def iter_search_statuses(
+    api: tweepy.API, terms: Sequence[str], lang: Optional[str] = None
+) -> Iterator[tweepy.Status]:
+    # Fetch full pages of 100 statuses per API call instead of one status per
+    # iteration, and request the next page in a background thread so the
+    # network round-trip overlaps with downstream processing of the current
+    # page
+    pages = tweepy.Cursor(
+        api.search, q=" OR ".join(terms), lang=lang, tweet_mode="extended", count=100
+    ).pages()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, pages, None)
+        while True:
+            page = future.result()
+            if page is None:
+                return
+            future = executor.submit(next, pages, None)
+            yield from page
+
+
 class StatusStreamGenerator(tweepy.StreamListener):
     def __init__(self, api: tweepy.API, limit: int = 0, **kwargs: Any):
         super().__init__(api)
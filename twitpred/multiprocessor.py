@@ -1,28 +1,56 @@
 import csv
+import itertools as it
 import logging
 import multiprocessing as mp
+import os
+import time
+from datetime import datetime
+from multiprocessing import shared_memory
+from queue import Empty
 from typing import (
     TYPE_CHECKING,
+    Callable,
+    Dict,
     Generic,
     Iterable,
     List,
     Optional,
+    Sequence,
     Tuple,
     TypeVar,
     Union,
 )
 
-from .generator import Tweet
+import numpy as np
+
+if TYPE_CHECKING:
+    import numpy.typing as npt
+
+from .generator import Tweet, TweetBatch
 from .predictor import TweetPredictor, TweetVectorizer, get_token_mapping
+from .processor import WRITE_BUFFER_BYTES, WRITE_BUFFER_ROWS, iter_batches
 
 logger = logging.getLogger(__name__)
 
-TweetPrediction = Tuple[Tweet, float]
+# upper bound of tokens kept per tweet; tweets are at most 280 characters so
+# this is generous, but it bounds the shared memory block size
+MAX_TOKENS = 512
+
+VectorizedTweet = Tuple[Tweet, Tuple[int, ...]]
+PredictedBatch = Tuple[TweetBatch, List[float]]
+# a vectorized batch lives in a shared memory block; only its metadata
+# (block name, padded array shape, tweets) crosses the queue, so the int32
+# vectors are neither pickled nor copied between processes
+BatchMeta = Tuple[str, Tuple[int, int], TweetBatch]
+# queues carry chunks of items so that each put/get amortizes its pickling
+# and syscall overhead over the whole chunk
 if TYPE_CHECKING:
-    TweetQueue = mp.Queue[Optional[Tweet]]
-    PredictedTweetQueue = mp.Queue[Optional[TweetPrediction]]
+    TweetQueue = mp.Queue[Optional[List[Tweet]]]
+    VectorizedBatchQueue = mp.Queue[Optional[List[BatchMeta]]]
+    PredictedBatchQueue = mp.Queue[Optional[List[PredictedBatch]]]
+    FreeBlockQueue = mp.Queue[str]
 else:
-    TweetQueue = PredictedTweetQueue = mp.Queue
+    TweetQueue = VectorizedBatchQueue = PredictedBatchQueue = FreeBlockQueue = mp.Queue
 
 X = TypeVar("X")
 Y = TypeVar("Y")
@@ -31,15 +59,21 @@ Y = TypeVar("Y")
 class ConsumerProducer(Generic[X, Y]):
     def __init__(
         self,
-        input_queue: "mp.Queue[Optional[X]]",
-        output_queue: "Optional[mp.Queue[Optional[Y]]]" = None,
+        input_queue: "mp.Queue[Optional[List[X]]]",
+        output_queues: "Sequence[mp.Queue[Optional[List[Y]]]]" = (),
         *,
+        max_wait: Optional[float] = None,
         name: Optional[str] = None,
         daemon: Optional[bool] = None,
     ):
         self._process = mp.Process(target=self._run, name=name, daemon=daemon)
         self._input_queue = input_queue
-        self._output_queue = output_queue
+        self._output_queues = output_queues
+        self._max_wait = max_wait
+        # set in the worker process by _run
+        self._next_output_queue: Optional[
+            Callable[[], "mp.Queue[Optional[List[Y]]]"]
+        ] = None
 
     def start(self) -> None:
         self._process.start()
@@ -60,74 +94,184 @@ class ConsumerProducer(Generic[X, Y]):
 
     def _run(self) -> None:
         consume = self._consume
-        produce = self._output_queue.put if self._output_queue is not None else None
+        get = self._input_queue.get
+        max_wait = self._max_wait
+        # spread the output chunks round-robin over the output queues
+        next_queue = (
+            it.cycle(self._output_queues).__next__ if self._output_queues else None
+        )
+        self._next_output_queue = next_queue
         with self:
-            for input in iter(self._input_queue.get, None):
-                outputs = consume(input)
-                if outputs is not None and produce is not None:
-                    for output in outputs:
-                        produce(output)
+            while True:
+                try:
+                    chunk = get(timeout=max_wait)
+                except Empty:
+                    self._flush()
+                    continue
+                if chunk is None:
+                    break
+                outputs: List[Y] = []
+                for input in chunk:
+                    item_outputs = consume(input)
+                    if item_outputs is not None:
+                        outputs.extend(item_outputs)
+                if outputs and next_queue is not None:
+                    next_queue().put(outputs)
 
     def _consume(self, item: X) -> Optional[Iterable[Y]]:
         pass
 
+    def _flush(self) -> None:
+        """Called when no input arrives within `max_wait` seconds."""
+
+
+class SharedMemoryBlocks:
+    """Attach to shared memory blocks by name, keeping the attachments open."""
 
-class TweetPredictorConsumerProducer(ConsumerProducer[Tweet, TweetPrediction]):
+    def __init__(self) -> None:
+        self._blocks: Dict[str, shared_memory.SharedMemory] = {}
+
+    def get_array(
+        self, name: str, shape: Tuple[int, int]
+    ) -> "npt.NDArray[np.int32]":
+        try:
+            block = self._blocks[name]
+        except KeyError:
+            block = self._blocks[name] = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype=np.int32, buffer=block.buf)
+
+    def close(self) -> None:
+        for block in self._blocks.values():
+            block.close()
+        self._blocks.clear()
+
+
+class TweetVectorizerConsumerProducer(ConsumerProducer[Tweet, BatchMeta]):
     def __init__(
         self,
         input_queue: TweetQueue,
-        output_queue: PredictedTweetQueue,
-        model_file: str,
+        output_queues: Sequence[VectorizedBatchQueue],
         vocabulary_file: str,
+        free_queue: FreeBlockQueue,
         batch_size: int = 1,
+        max_wait: Optional[float] = None,
         name: Optional[str] = None,
         daemon: Optional[bool] = None,
     ):
-        super().__init__(input_queue, output_queue, name=name, daemon=daemon)
-        self._model_file = model_file
+        super().__init__(
+            input_queue, output_queues, max_wait=max_wait, name=name, daemon=daemon
+        )
         self._vocabulary_file = vocabulary_file
+        self._free_queue = free_queue
         self._batch_size = batch_size
-        self._batch: List[Tweet] = []
+        self._batch: List[VectorizedTweet] = []
+        self._batch_start_time = 0.0
 
     def __enter__(self) -> None:
         super().__enter__()
-        vectorizer = TweetVectorizer(get_token_mapping(self._vocabulary_file))
-        # GPU cannot be (automatically) used among several processes
-        self._predictor = TweetPredictor(self._model_file, vectorizer, disable_gpu=True)
+        self._vectorizer = TweetVectorizer(get_token_mapping(self._vocabulary_file))
+        self._blocks = SharedMemoryBlocks()
 
     def __exit__(self, *exc: object) -> None:
-        if self._batch and self._output_queue is not None:
-            for tweetpred in self._batch_predict():
-                self._output_queue.put(tweetpred)
-            self._batch.clear()
+        self._flush()
+        self._blocks.close()
         return super().__exit__(*exc)
 
-    def _consume(self, tweet: Tweet) -> Iterable[TweetPrediction]:
-        if self._batch_size > 1:
-            if len(self._batch) == self._batch_size:
-                yield from self._batch_predict()
-                self._batch.clear()
-            self._batch.append(tweet)
-        else:
-            prediction = self._predictor.predict(tweet.full_text)
-            logger.debug("Predicted tweet %s", tweet.id)
-            yield tweet, prediction
-
-    def _batch_predict(self) -> Iterable[TweetPrediction]:
-        tweets = self._batch
-        predictions = self._predictor.batch_predict(
-            [tweet.full_text for tweet in tweets]
+    def _consume(self, tweet: Tweet) -> Iterable[BatchMeta]:
+        if not self._batch:
+            self._batch_start_time = time.monotonic()
+        self._batch.append((tweet, self._vectorizer(tweet.full_text)))
+        # emit a batch when it is full or has been pending for too long
+        if len(self._batch) >= self._batch_size or (
+            self._max_wait is not None
+            and time.monotonic() - self._batch_start_time >= self._max_wait
+        ):
+            yield self._pack_batch()
+            self._batch.clear()
+
+    def _flush(self) -> None:
+        if self._batch and self._next_output_queue is not None:
+            self._next_output_queue().put([self._pack_batch()])
+            self._batch.clear()
+
+    def _pack_batch(self) -> BatchMeta:
+        # write the left-padded batch into a free shared memory block; the
+        # predictor reads it in place and recycles the block when done
+        tweets = TweetBatch(tweet for tweet, _ in self._batch)
+        vectors = [vector[:MAX_TOKENS] for _, vector in self._batch]
+        shape = (len(vectors), max(map(len, vectors)))
+        name = self._free_queue.get()
+        array = self._blocks.get_array(name, shape)
+        array[:] = 0
+        for i, vector in enumerate(vectors):
+            if vector:
+                array[i, -len(vector) :] = vector
+        return name, shape, tweets
+
+
+class TweetPredictorConsumerProducer(ConsumerProducer[BatchMeta, PredictedBatch]):
+    def __init__(
+        self,
+        input_queue: VectorizedBatchQueue,
+        output_queues: Sequence[PredictedBatchQueue],
+        model_file: str,
+        free_queue: FreeBlockQueue,
+        worker_index: int = 0,
+        cores_per_worker: Optional[int] = None,
+        name: Optional[str] = None,
+        daemon: Optional[bool] = None,
+    ):
+        super().__init__(input_queue, output_queues, name=name, daemon=daemon)
+        self._model_file = model_file
+        self._free_queue = free_queue
+        self._worker_index = worker_index
+        self._cores_per_worker = cores_per_worker
+
+    def __enter__(self) -> None:
+        super().__enter__()
+        num_threads = self._pin_to_cores()
+        # GPU cannot be (automatically) used among several processes
+        self._predictor = TweetPredictor(
+            self._model_file, disable_gpu=True, num_threads=num_threads
         )
+        self._blocks = SharedMemoryBlocks()
+
+    def _pin_to_cores(self) -> Optional[int]:
+        # pin each worker to its own core subset so the OS doesn't migrate
+        # the heavy CPU inference across caches, and size the TF thread
+        # pools to match
+        if not self._cores_per_worker:
+            return None
+        first = self._worker_index * self._cores_per_worker
+        cores = set(range(first, first + self._cores_per_worker))
+        cores &= os.sched_getaffinity(0)
+        if not cores:
+            logger.warning("No available cores to pin %s", self)
+            return None
+        os.sched_setaffinity(0, cores)
+        os.environ["OMP_NUM_THREADS"] = str(len(cores))
+        logger.info("Pinned %s to cores %s", self, sorted(cores))
+        return len(cores)
+
+    def __exit__(self, *exc: object) -> None:
+        self._blocks.close()
+        return super().__exit__(*exc)
+
+    def _consume(self, batch_meta: BatchMeta) -> Iterable[PredictedBatch]:
+        name, shape, tweets = batch_meta
+        batch = self._blocks.get_array(name, shape)
+        predictions = self._predictor.batch_predict_array(batch)
+        # the model call has copied the data out, so the block can be reused
+        self._free_queue.put(name)
         assert len(predictions) == len(tweets)
-        ids = [tweet.id for tweet in tweets]
-        logger.debug("Predicted batch of %d tweets: %s", len(tweets), ids)
-        return zip(tweets, predictions)
+        logger.debug("Predicted batch of %d tweets: %s", len(tweets), tweets.ids)
+        return [(tweets, predictions)]
 
 
-class CsvWriterConsumer(ConsumerProducer[TweetPrediction, None]):
+class CsvWriterConsumer(ConsumerProducer[PredictedBatch, None]):
     def __init__(
         self,
-        queue: PredictedTweetQueue,
+        queue: PredictedBatchQueue,
         csv_file: str,
         dialect: Union[csv.Dialect, str] = "excel-tab",
         name: Optional[str] = None,
@@ -140,19 +284,28 @@ class CsvWriterConsumer(ConsumerProducer[TweetPrediction, None]):
     def __enter__(self) -> None:
         super().__enter__()
         self._consumed = 0
-        self._file = open(self._csv_file, "w", newline="")
-        self._writerow = csv.writer(self._file, dialect=self._dialect).writerow
-        self._writerow(("tweet_id", "created_at", "full_text", "sentiment"))
+        self._rows: List[Tuple[int, datetime, str, float]] = []
+        self._file = open(
+            self._csv_file, "w", newline="", buffering=WRITE_BUFFER_BYTES
+        )
+        writer = csv.writer(self._file, dialect=self._dialect)
+        writer.writerow(("tweet_id", "created_at", "full_text", "sentiment"))
+        self._writerows = writer.writerows
 
     def __exit__(self, *exc: object) -> None:
+        self._writerows(self._rows)
+        self._rows.clear()
         self._file.close()
         return super().__exit__(*exc)
 
-    def _consume(self, tweet_prediction: TweetPrediction) -> None:
-        tweet, prediction = tweet_prediction
-        self._writerow((*tweet, prediction))
-        self._consumed += 1
-        logger.debug("Wrote row %d for tweet %s", self._consumed, tweet.id)
+    def _consume(self, batch_prediction: PredictedBatch) -> None:
+        batch, predictions = batch_prediction
+        self._rows.extend(zip(batch.ids, batch.times, batch.texts, predictions))
+        self._consumed += len(batch)
+        logger.debug("Buffered %d rows so far", self._consumed)
+        if len(self._rows) >= WRITE_BUFFER_ROWS:
+            self._writerows(self._rows)
+            self._rows.clear()
 
 
 def multiprocess_tweets(
@@ -162,40 +315,94 @@ def multiprocess_tweets(
     output_file: str,
     batch_size: int,
     num_processes: int,
+    num_vectorizer_processes: int = 1,
+    max_wait: Optional[float] = None,
+    cores_per_worker: Optional[int] = None,
 ) -> None:
-    input_queue: TweetQueue = mp.Queue()
-    output_queue: PredictedTweetQueue = mp.Queue()
-
-    # start the predictor workers
-    predictors = [
-        TweetPredictorConsumerProducer(
-            input_queue=input_queue,
-            output_queue=output_queue,
-            model_file=model_file,
-            vocabulary_file=vocabulary_file,
-            batch_size=batch_size,
-            name=f"PredictorProcess-{i}",
+    # each worker binds to exactly one input queue to avoid contending on a
+    # single queue lock; producers shard their output round-robin
+    input_queues: List[TweetQueue] = [
+        mp.Queue() for _ in range(num_vectorizer_processes)
+    ]
+    vectorized_queues: List[VectorizedBatchQueue] = [
+        mp.Queue() for _ in range(num_processes)
+    ]
+    output_queue: PredictedBatchQueue = mp.Queue()
+
+    # pool of shared memory blocks for the vectorized batches; the free block
+    # names circulate between the vectorizers and the predictors
+    free_queue: FreeBlockQueue = mp.Queue()
+    blocks = [
+        shared_memory.SharedMemory(
+            create=True, size=batch_size * MAX_TOKENS * np.dtype(np.int32).itemsize
         )
-        for i in range(num_processes)
+        for _ in range(4 * num_processes)
     ]
-    for predictor in predictors:
-        predictor.start()
-
-    # start the csv writer worker
-    writer = CsvWriterConsumer(output_queue, output_file, name="WriterProcess")
-    writer.start()
-
-    # push all tweets to the input queue
-    for tweet in tweets:
-        input_queue.put(tweet)
-
-    # notify all predictor workers to stop
-    for predictor in predictors:
-        predictor.stop(block=False)
-
-    # block until all predictor workers exit
-    for predictor in predictors:
-        predictor.join()
-
-    # notify the writer worker to stop
-    writer.stop()
+    for block in blocks:
+        free_queue.put(block.name)
+
+    try:
+        # start the vectorizer workers, so that the Python-heavy
+        # regex/tokenizer work doesn't stall the predictor workers between
+        # batches
+        vectorizers = [
+            TweetVectorizerConsumerProducer(
+                input_queue=input_queues[i],
+                output_queues=vectorized_queues,
+                vocabulary_file=vocabulary_file,
+                free_queue=free_queue,
+                batch_size=batch_size,
+                max_wait=max_wait,
+                name=f"VectorizerProcess-{i}",
+            )
+            for i in range(num_vectorizer_processes)
+        ]
+        for vectorizer in vectorizers:
+            vectorizer.start()
+
+        # start the predictor workers
+        predictors = [
+            TweetPredictorConsumerProducer(
+                input_queue=vectorized_queues[i],
+                output_queues=[output_queue],
+                model_file=model_file,
+                free_queue=free_queue,
+                worker_index=i,
+                cores_per_worker=cores_per_worker,
+                name=f"PredictorProcess-{i}",
+            )
+            for i in range(num_processes)
+        ]
+        for predictor in predictors:
+            predictor.start()
+
+        # start the csv writer worker
+        writer = CsvWriterConsumer(output_queue, output_file, name="WriterProcess")
+        writer.start()
+
+        # push the tweets in chunks round-robined over the input queues
+        for chunk, input_queue in zip(
+            iter_batches(tweets, batch_size), it.cycle(input_queues)
+        ):
+            input_queue.put(chunk)
+
+        # notify all vectorizer workers to stop and block until they exit
+        for vectorizer in vectorizers:
+            vectorizer.stop(block=False)
+        for vectorizer in vectorizers:
+            vectorizer.join()
+
+        # notify all predictor workers to stop and block until they exit
+        for predictor in predictors:
+            predictor.stop(block=False)
+        for predictor in predictors:
+            predictor.join()
+
+        # notify the writer worker to stop
+        writer.stop()
+    finally:
+        # release the shared memory blocks even if the pipeline failed, or
+        # they would leak in /dev/shm until reboot
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -1,22 +1,55 @@
+import functools
 import json
+import os
+import pickle
 import re
-from collections import defaultdict
-from typing import Iterable, List, Mapping
+import sys
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
+import numpy as np
 import tensorflow as tf
-from nltk.tokenize.casual import EMOTICON_RE, URLS, TweetTokenizer
+from nltk.tokenize.casual import EMOTICON_RE, URLS
+
+if TYPE_CHECKING:
+    import numpy.typing as npt
+
+try:
+    # RE2 runs as a linear-time DFA, immune to the catastrophic backtracking
+    # the huge URL alternation can hit on pathological tweets
+    import re2
+except ImportError:
+    re2 = None
 
 RE_FLAGS = re.VERBOSE | re.IGNORECASE | re.UNICODE
 
+
+def compile_regex(pattern: str, flags: int = 0) -> "re.Pattern[str]":
+    """Compile with Google RE2 if installed, falling back to stdlib `re`."""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern, flags)
+        except Exception:
+            pass  # RE2 doesn't support the pattern (e.g. lookaround)
+    return re.compile(pattern, flags)
+
+
 # urls, see https://gist.github.com/winzig/8894715
-URLS_RE = re.compile(URLS, RE_FLAGS)
+URLS_PATTERN = URLS
 # Twitter username
-USERNAMES_RE = re.compile(r"(?:@[\w_]+)", RE_FLAGS)
+USERNAMES_PATTERN = r"(?:@[\w_]+)"
 # Twitter hashtags
-HASHTAGS_RE = re.compile(r"(?:\#+[\w_]+[\w\'_\-]*[\w_]+)", RE_FLAGS)
+HASHTAGS_PATTERN = r"(?:\#+[\w_]+[\w\'_\-]*[\w_]+)"
 # Numbers including decimals.
-NUMBERS_RE = re.compile(
-    r"""
+NUMBERS_PATTERN = r"""
 (?:
     [+\-]?
     (?:
@@ -25,27 +58,99 @@ NUMBERS_RE = re.compile(
         [,.]\d+
     )
 )
-""",
+"""
+# Single alternation over all the patterns to normalize, so that preprocessing
+# makes one pass over the text instead of one `re.sub` pass per pattern.
+# Known divergences from the original sequential substitution, both on inputs
+# the old passes mangled: "me@example.com" now becomes "me<user>.com" instead
+# of "me<user><url>" (the username alternative wins before the url pattern
+# sees the domain), and "<3" is kept intact as an emoticon instead of becoming
+# "<<number>". Pinned by tests/test_preprocess.py.
+PREPROCESS_RE = compile_regex(
+    f"(?P<url>{URLS_PATTERN})"
+    f"|(?P<user>{USERNAMES_PATTERN})"
+    f"|(?P<hashtag>{HASHTAGS_PATTERN})"
+    f"|(?P<number>{NUMBERS_PATTERN})"
+    f"|(?P<emoticon>{EMOTICON_RE.pattern})",
     RE_FLAGS,
 )
+# Tokens remaining after preprocessing: a normalized placeholder (e.g.
+# "<url>"), a word (possibly with apostrophes) or a single punctuation
+# character. A single findall over this beats TweetTokenizer's long chain of
+# per-tweet Python-level substitutions and conditionals.
+TOKEN_RE = compile_regex(r"<\w+>|[\w']+|[^\s\w]", re.UNICODE)
+
+# interned placeholders: preprocessing substitutes the same string objects
+# over and over, and interned vocabulary keys let dict lookups short-circuit
+# on identity before falling back to a full string comparison
+SPECIAL_TOKENS = {
+    "url": sys.intern("<url>"),
+    "user": sys.intern("<user>"),
+    "hashtag": sys.intern("<hashtag>"),
+    "number": sys.intern("<number>"),
+}
+
+
+class UnkDict(Dict[str, int]):
+    """Dict returning a fixed value for missing keys.
+
+    Unlike ``defaultdict(lambda: unknown)`` it is picklable and doesn't
+    insert the missing keys.
+    """
+
+    def __init__(self, mapping: Mapping[str, int], unknown: int):
+        super().__init__(mapping)
+        self.unknown = unknown
+
+    def __missing__(self, token: str) -> int:
+        return self.unknown
+
+
+def _intern_tokens(token_mapping: UnkDict) -> UnkDict:
+    return UnkDict(
+        {sys.intern(token): index for token, index in token_mapping.items()},
+        token_mapping.unknown,
+    )
 
 
 def get_token_mapping(vocabulary_file: str) -> Mapping[str, int]:
+    # cache the parsed vocabulary as a pickle next to the JSON: unpickling a
+    # dict is much faster than parsing JSON, which adds up when every worker
+    # process loads the vocabulary at startup
+    pickle_file = vocabulary_file + ".pkl"
+    try:
+        if os.path.getmtime(pickle_file) >= os.path.getmtime(vocabulary_file):
+            with open(pickle_file, "rb") as f:
+                return _intern_tokens(pickle.load(f))
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass  # missing or corrupt cache; fall back to parsing the JSON
     with open(vocabulary_file) as f:
         d = json.load(f)
-    unknown = d.pop("*#*UNK*#*")
-    return defaultdict(lambda: unknown, **d)
+    token_mapping = _intern_tokens(UnkDict(d, unknown=d.pop("*#*UNK*#*")))
+    # write to a per-process temp file and rename it into place, so that
+    # concurrently starting workers never read a partially written cache
+    temp_file = f"{pickle_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, "wb") as f:
+            pickle.dump(token_mapping, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, pickle_file)
+    except OSError:
+        pass  # e.g. read-only directory; just reparse the JSON next time
+    return token_mapping
 
 
 class TweetVectorizer:
     _emoticon_mapping = {
-        ":-)": "<smileface>",
-        ":)": "<smileface>",
-        ":D": "<lolface>",
-        ":-D": "<lolface>",
-        ":|": "<neutralface>",
-        ":-(": "<sadface>",
-        ":(": "<sadface>",
+        emoticon: sys.intern(token)
+        for emoticon, token in (
+            (":-)", "<smileface>"),
+            (":)", "<smileface>"),
+            (":D", "<lolface>"),
+            (":-D", "<lolface>"),
+            (":|", "<neutralface>"),
+            (":-(", "<sadface>"),
+            (":(", "<sadface>"),
+        )
     }
 
     def __init__(
@@ -54,41 +159,173 @@ class TweetVectorizer:
         preserve_case: bool = False,
     ):
         self._token_mapping = token_mapping
-        self._tokenizer = TweetTokenizer(preserve_case=preserve_case)
+        self._preserve_case = preserve_case
+        # retweets and trending phrases repeat heavily in twitter streams, so
+        # cache the vectorization of recently seen texts
+        self._vectorize = functools.lru_cache(maxsize=2 ** 16)(self._vectorize_uncached)
+
+    def __call__(self, text: str) -> Tuple[int, ...]:
+        return self._vectorize(text)
 
-    def __call__(self, text: str) -> List[int]:
-        token_mapping = self._token_mapping
-        return [token_mapping[token] for token in self.tokenize(text)]
+    def _vectorize_uncached(self, text: str) -> Tuple[int, ...]:
+        # map() runs the per-token lookup entirely in C, without resuming a
+        # generator frame per token
+        return tuple(map(self._token_mapping.__getitem__, self.tokenize(text)))
 
     def tokenize(self, text: str) -> List[str]:
-        return self._tokenizer.tokenize(self.preprocess(text))
+        text = self.preprocess(text)
+        if not self._preserve_case:
+            text = text.lower()
+        return TOKEN_RE.findall(text)
 
     def preprocess(self, text: str) -> str:
-        get_emoticon = self._emoticon_mapping.get
-        text = URLS_RE.sub("<url>", text)
-        text = USERNAMES_RE.sub("<user>", text)
-        text = HASHTAGS_RE.sub("<hashtag>", text)
-        text = NUMBERS_RE.sub("<number>", text)
-        text = EMOTICON_RE.sub(lambda m: get_emoticon(m.group()) or m.group(), text)
-        return text
+        return PREPROCESS_RE.sub(self._replace_match, text)
+
+    def _replace_match(self, match: "re.Match[str]") -> str:
+        group = match.lastgroup
+        assert group is not None  # every alternative is a named group
+        if group == "emoticon":
+            return self._emoticon_mapping.get(match.group(), match.group())
+        return SPECIAL_TOKENS[group]
 
 
 class TweetPredictor:
     def __init__(
-        self, model_file: str, vectorizer: TweetVectorizer, disable_gpu: bool = False
+        self,
+        model_file: str,
+        vectorizer: Optional[TweetVectorizer] = None,
+        disable_gpu: bool = False,
+        num_threads: Optional[int] = None,
     ):
+        # `vectorizer` may be omitted if only batch_predict_vectors is used
         if disable_gpu:
             tf.config.set_visible_devices([], device_type="GPU")
-        self._model = tf.keras.models.load_model(model_file)
+        if num_threads is not None:
+            # must be set before the TF runtime creates any ops
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
         self._vectorizer = vectorizer
+        if model_file.endswith(".tflite"):
+            # quantized model produced by tools/quantize.py
+            self._interpreter = tf.lite.Interpreter(
+                model_path=model_file, num_threads=num_threads or 2
+            )
+            self._input_index = self._interpreter.get_input_details()[0]["index"]
+            self._output_index = self._interpreter.get_output_details()[0]["index"]
+        else:
+            self._interpreter = None
+            self._model = tf.keras.models.load_model(model_file)
+            # The embedding rows of a sequence are a pure function of its token
+            # ids, so gather them outside the model with a plain numpy fancy
+            # index and run the remaining layers as a sub-model on the
+            # pre-embedded input.
+            embedding_index = next(
+                i
+                for i, layer in enumerate(self._model.layers)
+                if isinstance(layer, tf.keras.layers.Embedding)
+            )
+            embedding = self._model.layers[embedding_index]
+            # slicing off the Embedding would silently drop the padding mask
+            # the downstream layers rely on
+            assert not embedding.mask_zero, "mask_zero embeddings are not supported"
+            self._embeddings = embedding.get_weights()[0].astype(np.float32)
+            sub_model = tf.keras.Sequential(self._model.layers[embedding_index + 1 :])
+            # cache for the single-tweet path only, keyed on the unpadded
+            # vector; kept small since each entry is a (len, dim) float32 array
+            self._embed = functools.lru_cache(maxsize=2 ** 12)(self._embed_uncached)
+            # Calling the model through a tf.function skips the DataAdapter and
+            # per-batch callback machinery of Model.predict that dominates
+            # small-batch latency. No XLA here: jit_compile recompiles for
+            # every distinct batch shape, and padded batch lengths vary freely,
+            # so relax the traced shapes instead
+            self._call = tf.function(
+                lambda batch: sub_model(batch, training=False),
+                experimental_relax_shapes=True,
+            )
+            # specialized single-tweet entry point: the fixed input signature
+            # is traced once and skips per-call dispatch on the tensor shape
+            self._predict_one = tf.function(
+                lambda batch: tf.squeeze(sub_model(batch, training=False)),
+                input_signature=[
+                    tf.TensorSpec([1, None, self._embeddings.shape[1]], tf.float32)
+                ],
+            )
+            # warm up both entry points once so the initial tracing happens
+            # outside the hot path
+            dummy = tf.zeros((1, 1, self._embeddings.shape[1]), dtype=tf.float32)
+            self._call(dummy)
+            self._predict_one(dummy)
+
+    def _embed_uncached(self, vector: Tuple[int, ...]) -> "npt.NDArray[np.float32]":
+        return self._embeddings[np.asarray(vector, dtype=np.int32)]
 
     def predict(self, text: str) -> float:
+        assert self._vectorizer is not None, "predict() requires a vectorizer"
         vector = self._vectorizer(text)
-        return self._model.predict([vector]).item()
+        if self._interpreter is not None:
+            return self.batch_predict_vectors([vector])[0]
+        embedded = self._embed(vector)[np.newaxis]
+        return float(self._predict_one(tf.constant(embedded)).numpy())
 
     def batch_predict(self, texts: Iterable[str]) -> List[float]:
-        vectors = list(map(self._vectorizer, texts))
+        assert self._vectorizer is not None, "batch_predict() requires a vectorizer"
+        texts = list(texts)
+        if not texts:
+            return []
+        # predict each distinct text once and scatter the results back, so
+        # that duplicated texts don't inflate the padded batch
+        unique_indices = {text: i for i, text in enumerate(dict.fromkeys(texts))}
+        vectors = list(map(self._vectorizer, unique_indices))
+        predictions = self.batch_predict_vectors(vectors)
+        return [predictions[unique_indices[text]] for text in texts]
+
+    def batch_predict_vectors(self, vectors: List[Tuple[int, ...]]) -> List[float]:
         if not vectors:
             return []
-        vectors = tf.keras.preprocessing.sequence.pad_sequences(vectors)
-        return self._model.predict(vectors).ravel().tolist()
+        # materialize the left-padded batch directly into a preallocated int32
+        # array, bypassing pad_sequences' per-row Python list handling
+        max_len = max(map(len, vectors))
+        batch = np.zeros((len(vectors), max_len), dtype=np.int32)
+        for i, vector in enumerate(vectors):
+            if vector:
+                batch[i, -len(vector) :] = vector
+        return self.batch_predict_array(batch)
+
+    def iter_batch_predictions(
+        self, vectors: Iterable[Tuple[int, ...]], batch_size: int
+    ) -> Iterator[List[float]]:
+        """Predict a stream of vectors, yielding one list of predictions per batch.
+
+        The vectors are batched and padded by a prefetching tf.data pipeline,
+        so vectorization and padding of the next batch overlap with the
+        inference of the current one instead of being serialized.
+        """
+        # padded_batch only right-pads, but every other path left-pads like
+        # the original pad_sequences default (and padding side changes the
+        # predictions), so feed the vectors reversed and flip the padded
+        # batches back
+        dataset = tf.data.Dataset.from_generator(
+            lambda: (vector[::-1] for vector in vectors),
+            output_types=tf.int32,
+            output_shapes=[None],
+        )
+        dataset = dataset.padded_batch(batch_size, padded_shapes=[None])
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        for batch in dataset:
+            yield self.batch_predict_array(tf.reverse(batch, axis=[1]).numpy())
+
+    def batch_predict_array(self, batch: "npt.NDArray[np.int32]") -> List[float]:
+        """Predict a batch that is already a padded (num_texts, max_len) array."""
+        if len(batch) == 0:
+            return []
+        if self._interpreter is not None:
+            interpreter = self._interpreter
+            interpreter.resize_tensor_input(self._input_index, batch.shape)
+            interpreter.allocate_tensors()
+            interpreter.set_tensor(self._input_index, np.ascontiguousarray(batch))
+            interpreter.invoke()
+            return interpreter.get_tensor(self._output_index).ravel().tolist()
+        # a single fancy index gathers the whole batch in C; caching per row
+        # would only add tuple-hashing overhead here
+        embedded = self._embeddings[batch]
+        return self._call(tf.convert_to_tensor(embedded)).numpy().ravel().tolist()
@@ -1,13 +1,20 @@
 import csv
 import itertools as it
 import logging
-from typing import Iterable, List, Tuple, TypeVar
+from collections import deque
+from datetime import datetime
+from typing import Deque, Iterable, Iterator, List, Tuple, TypeVar
 
-from .generator import Tweet
+from .generator import Tweet, TweetBatch
 from .predictor import TweetPredictor, TweetVectorizer, get_token_mapping
 
 logger = logging.getLogger(__name__)
 
+# number of csv rows to accumulate before handing them to the writer, and
+# size of the underlying file buffer
+WRITE_BUFFER_ROWS = 256
+WRITE_BUFFER_BYTES = 1 << 20
+
 
 def process_tweets(
     tweets: Iterable[Tweet],
@@ -18,16 +25,25 @@ def process_tweets(
 ) -> None:
     vectorizer = TweetVectorizer(get_token_mapping(vocabulary_file))
     predictor = TweetPredictor(model_file, vectorizer)
-    if batch_size > 1:
-        tweet_preds = iter_batch_predictions(tweets, predictor, batch_size)
-    else:
-        tweet_preds = iter_predictions(tweets, predictor)
-    with open(output_file, "w", newline="") as f:
-        writerow = csv.writer(f, dialect="excel-tab").writerow
-        writerow(("tweet_id", "created_at", "full_text", "sentiment"))
-        for i, (tweet, prediction) in enumerate(tweet_preds, start=1):
-            writerow((*tweet, prediction))
-            logger.debug("Wrote row %d for tweet %s", i, tweet.id)
+    with open(output_file, "w", newline="", buffering=WRITE_BUFFER_BYTES) as f:
+        writer = csv.writer(f, dialect="excel-tab")
+        writer.writerow(("tweet_id", "created_at", "full_text", "sentiment"))
+        if batch_size > 1:
+            for batch, predictions in iter_batch_predictions(
+                tweets, vectorizer, predictor, batch_size
+            ):
+                writer.writerows(zip(batch.ids, batch.times, batch.texts, predictions))
+        else:
+            rows: List[Tuple[int, datetime, str, float]] = []
+            for i, (tweet, prediction) in enumerate(
+                iter_predictions(tweets, predictor), start=1
+            ):
+                rows.append((*tweet, prediction))
+                logger.debug("Buffered row %d for tweet %s", i, tweet.id)
+                if len(rows) >= WRITE_BUFFER_ROWS:
+                    writer.writerows(rows)
+                    rows.clear()
+            writer.writerows(rows)
 
 
 def iter_predictions(
@@ -40,14 +56,52 @@ def iter_predictions(
 
 
 def iter_batch_predictions(
-    tweets: Iterable[Tweet], predictor: TweetPredictor, batch_size: int
-) -> Iterable[Tuple[Tweet, float]]:
-    for batch in iter_batches(tweets, batch_size):
-        predictions = predictor.batch_predict([tweet.full_text for tweet in batch])
-        assert len(predictions) == len(batch)
-        ids = [tweet.id for tweet in batch]
-        logger.debug("Predicted batch of %d tweets: %s", len(batch), ids)
-        yield from zip(batch, predictions)
+    tweets: Iterable[Tweet],
+    vectorizer: TweetVectorizer,
+    predictor: TweetPredictor,
+    batch_size: int,
+    window_batches: int = 8,
+) -> Iterable[Tuple[TweetBatch, List[float]]]:
+    # Batches are padded to the longest vector in each batch, so grouping
+    # similarly sized vectors together minimizes the padding waste. Consume
+    # tweets in windows of `window_batches` batches, sort each window by
+    # vector length before splitting it into batches, then restore the
+    # original order when yielding the predictions. The sorted vectors are
+    # fed to the predictor as a single stream so its prefetching tf.data
+    # pipeline can overlap vectorization with inference across windows.
+    windows: Deque[TweetBatch] = deque()
+    orders: Deque[List[int]] = deque()
+
+    def iter_sorted_vectors() -> Iterator[Tuple[int, ...]]:
+        for tweet_batch in iter_batches(tweets, window_batches * batch_size):
+            window = TweetBatch(tweet_batch)
+            vectors = [vectorizer(text) for text in window.texts]
+            order = sorted(
+                range(len(window)), key=lambda i: len(vectors[i]), reverse=True
+            )
+            windows.append(window)
+            orders.append(order)
+            for i in order:
+                yield vectors[i]
+
+    predictions: List[float] = []
+    for batch_predictions in predictor.iter_batch_predictions(
+        iter_sorted_vectors(), batch_size
+    ):
+        predictions.extend(batch_predictions)
+        # the pipeline may prefetch ahead of us; emit every window that has
+        # been fully predicted
+        while windows and len(predictions) >= len(windows[0]):
+            window = windows.popleft()
+            order = orders.popleft()
+            window_predictions = [0.0] * len(window)
+            for i, prediction in zip(order, predictions):
+                window_predictions[i] = prediction
+            del predictions[: len(window)]
+            logger.debug(
+                "Predicted window of %d tweets: %s", len(window), window.ids
+            )
+            yield window, window_predictions
 
 
 T = TypeVar("T")